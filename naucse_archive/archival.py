@@ -1,7 +1,10 @@
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
 from pathlib import Path
+import collections
 import contextlib
 import subprocess
+import threading
 import textwrap
 import tempfile
 import datetime
@@ -22,14 +25,41 @@ FETCH_DEPTH = 10
 CONTAINER_PYTHON_COMMAND = '/naucse/env/bin/python'
 PIP_CACHE_DIR = '.naucse-archive/pip-cache'
 
+# Words of shell commands that don't need quoting
+_SAFE_WORD_RE = re.compile(r'^[-_.=/:a-zA-Z0-9]+\Z')
+# Characters replaced in names of static files
+_STATIC_NAME_UNSAFE_RE = re.compile('[^a-z0-9./_-]+')
+# Characters escaped by git_config_key
+_CONFIG_KEY_UNSAFE_RE = re.compile('[^a-z0-9]')
+
+# Courses may be archived in parallel threads.
+# Git operations that write to the shared data repository (fetches, config,
+# worktree add/remove) must hold _git_lock;
+# only one thread at a time may build a given container image
+# or fill a given piptools cache directory;
+# output (to stdout or stderr) is printed while holding _print_lock.
+_git_lock = threading.Lock()
+_image_locks = collections.defaultdict(threading.Lock)
+_piptools_locks = collections.defaultdict(threading.Lock)
+_print_lock = threading.Lock()
+
+# Names of container images known to exist (True) or not (False).
+# Checked (and updated) by ImageMaker while holding the image's lock.
+_image_exists_cache = {}
+
+# Names of images made by get_image_from_requirements,
+# keyed by (python_version, requirements hash)
+_image_name_cache = {}
+
 def printerr(*args, **kwargs):
     """print to stderr"""
-    print(*args, **kwargs, file=sys.stderr)
+    with _print_lock:
+        print(*args, **kwargs, file=sys.stderr)
 
 def _quote_cmd_word(word):
     """Quote a word of a shell command"""
     word = str(word)
-    if re.match('^[-_.=/:a-zA-Z0-9]+$', word):
+    if _SAFE_WORD_RE.match(word):
         return word
     word_repl = word.replace("'", r"'\''")
     return f"'{word_repl}'"
@@ -40,11 +70,7 @@ def run(*cmd, check=True, encoding='utf-8', **kwargs):
     Like subprocess.run(), with different defaults and logging to stderr"""
     printerr('$', ' '.join(_quote_cmd_word(c) for c in cmd))
     start_time = time.time()
-    env = {
-        **kwargs.pop('env', os.environ),
-        'GIT_CONFIG_GLOBAL': '/dev/null',
-        'GIT_CONFIG_SYSTEM': '/dev/null',
-    }
+    env = command_env(kwargs.pop('env', os.environ))
     try:
         proc = subprocess.run(cmd, check=check, encoding=encoding, env=env, **kwargs)
     except subprocess.CalledProcessError as e:
@@ -57,8 +83,35 @@ def run(*cmd, check=True, encoding='utf-8', **kwargs):
         printerr(_quote_cmd_word(cmd[0]), '->', returncode, f'({elapsed:.2f}s)')
     return proc
 
+def run_to_file(*cmd, dest, **kwargs):
+    """Run the given command, saving its stdout to the file `dest`.
+
+    The command writes to the file directly, without going through Python.
+    Output goes to a temporary file that's renamed to `dest` when
+    the command succeeds, so `dest` is never left incomplete.
+    """
+    tmp_path = dest.with_name(
+        f'.{dest.name}.{os.getpid()}-{threading.get_ident()}.tmp'
+    )
+    try:
+        with tmp_path.open('wb') as f:
+            proc = run(*cmd, stdout=f, **kwargs)
+        os.replace(tmp_path, dest)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    return proc
+
+def command_env(env):
+    """Return environment for commands run by this tool"""
+    return {
+        **env,
+        'GIT_CONFIG_GLOBAL': '/dev/null',
+        'GIT_CONFIG_SYSTEM': '/dev/null',
+    }
+
 
-def archive(course_def, data_path, output_path, cache_path, container_command):
+def archive(course_def, data_path, output_path, cache_path, container_command, git_batch):
     """Archive a single course."""
     slug = course_def['slug']
     repo = course_def['source']['repo']
@@ -69,23 +122,37 @@ def archive(course_def, data_path, output_path, cache_path, container_command):
     branch_ref = f'refs/remotes/{remote_name}/{branch}'
 
     (data_path / PIP_CACHE_DIR).mkdir(exist_ok=True, parents=True)
+    output_path.mkdir(exist_ok=True, parents=True)
 
     with contextlib.ExitStack() as context:
-        fetch(data_path, repo, remote_name)
-        commit_id = get_commit_id(data_path, branch_ref)
-        worktree = make_worktree(data_path, branch_ref, context)
+        # All temporary directories for this course are created in
+        # scratch_path, and removed all at once with it.
+        # It's in output_path, so the result can be moved rather than copied.
+        scratch_path = Path(context.enter_context(
+            tempfile.TemporaryDirectory(dir=output_path, prefix='.naucse-tmp-')
+        ))
+        fetch(data_path, repo, remote_name, git_batch)
+        commit_id = get_commit_id(git_batch, branch_ref)
+        worktree = make_worktree(data_path, branch_ref, context, scratch_path)
         get_image = choose_get_image(worktree)
         image = get_image(data_path, worktree, cache_path, container_command)
 
-        result_path = context.enter_context(tempdir_path())
+        result_path = context.enter_context(tempdir_path(scratch_path))
         save_env_info(container_command, worktree, commit_id, image, slug, result_path)
-        save_course(container_command, worktree, course_def, commit_id, image, slug, result_path)
+        save_course(
+            container_command, worktree, course_def, commit_id, image, slug,
+            result_path, scratch_path=scratch_path,
+        )
 
         dest_path = output_path / slug
         if dest_path.exists():
             shutil.rmtree(dest_path)
         dest_path.parent.mkdir(exist_ok=True, parents=True)
-        shutil.copytree(result_path, dest_path)
+        try:
+            os.rename(result_path, dest_path)
+        except OSError:
+            # e.g. output_path/slug is on another filesystem
+            shutil.copytree(result_path, dest_path)
 
     return slug, {
         'path': slug,
@@ -94,7 +161,7 @@ def archive(course_def, data_path, output_path, cache_path, container_command):
     }
 
 
-def fetch(data_path, repo, remote_name):
+def fetch(data_path, repo, remote_name, git_batch):
     """Fetch the given Git remote
 
     A remote is created with the given `repo` URL, if it doesn't already exist.
@@ -102,73 +169,205 @@ def fetch(data_path, repo, remote_name):
     (The last fetch time is stored in Git config; remove the entry to force
     refetch.)
     """
+    with _git_lock:
+        now = datetime.datetime.now()
+        if _fetched_recently(git_batch, remote_name, now):
+            return
+        if _add_remote(data_path, repo, remote_name):
+            run(
+                'git', 'fetch', remote_name,
+                '--depth', str(FETCH_DEPTH),
+                cwd=data_path,
+            )
+        else:
+            run(
+                'git', 'fetch', remote_name,
+                cwd=data_path,
+            )
+        _set_last_fetch(data_path, remote_name, now, git_batch)
+
+
+def fetch_all(data_path, course_defs, git_batch, jobs=8):
+    """Fetch the Git remotes of all the given courses
+
+    Like calling `fetch` for each course, but the remotes are fetched
+    in parallel by a single `git fetch --multiple` command.
+    After this, `fetch` for these courses is a no-op (see REFETCH_TIME).
+    """
+    seen = set()
+    new_remotes = []
+    old_remotes = []
+    with _git_lock:
+        now = datetime.datetime.now()
+        for course_def in course_defs:
+            repo = course_def['source']['repo']
+            remote_name = git_config_key(repo)
+            if remote_name in seen:
+                continue
+            seen.add(remote_name)
+            if _fetched_recently(git_batch, remote_name, now):
+                continue
+            if _add_remote(data_path, repo, remote_name):
+                new_remotes.append(remote_name)
+            else:
+                old_remotes.append(remote_name)
+        if old_remotes:
+            run(
+                'git', 'fetch', '--multiple', f'--jobs={jobs}',
+                *old_remotes,
+                cwd=data_path,
+            )
+        if new_remotes:
+            run(
+                'git', 'fetch', '--multiple', f'--jobs={jobs}',
+                '--depth', str(FETCH_DEPTH),
+                *new_remotes,
+                cwd=data_path,
+            )
+        for remote_name in old_remotes + new_remotes:
+            _set_last_fetch(data_path, remote_name, now, git_batch)
+
+
+def _fetched_recently(git_batch, remote_name, now):
+    """Return true if the given remote was fetched within REFETCH_TIME"""
+    last_fetch = git_batch.config.get(f'naucse.last_fetch.{remote_name}')
+    if last_fetch:
+        last_fetch_date = datetime.datetime.fromisoformat(last_fetch)
+        refetch_delta = datetime.timedelta(seconds=REFETCH_TIME)
+        if last_fetch_date + refetch_delta > now:
+            return True
+    return False
+
+
+def _set_last_fetch(data_path, remote_name, now, git_batch):
     config_key = f'naucse.last_fetch.{remote_name}'
-    proc = run(
-        'git', 'config', config_key,
+    run(
+        'git', 'config', config_key, now.isoformat(),
         cwd=data_path,
         check=False,
         stdout=subprocess.PIPE
     )
-    last_fetch = proc.stdout.strip()
-    now = datetime.datetime.now()
-    if last_fetch:
-        last_fetch_date = datetime.datetime.fromisoformat(last_fetch)
-        refetch_delta = datetime.timedelta(seconds=REFETCH_TIME)
-        if last_fetch_date + refetch_delta > now:
-            return
+    git_batch.config[config_key] = now.isoformat()
+
+
+def _add_remote(data_path, repo, remote_name):
+    """Add a Git remote. Return false if it already exists.
 
+    New remotes are set up for partial clone: file contents (blobs) are
+    only downloaded when needed, i.e. when a worktree is checked out.
+    (Fetches from the remote use the configured filter automatically;
+    `git fetch --multiple` doesn't allow an explicit `--filter`.)
+    """
     proc = run(
         'git', 'remote', 'add', remote_name, repo,
         cwd=data_path,
         check=False,
     )
     if proc.returncode == 3:
-        run(
-            'git', 'fetch', remote_name,
-            cwd=data_path,
-        )
-    else:
-        run(
-            'git', 'fetch', remote_name,
-            '--depth', str(FETCH_DEPTH),
-            cwd=data_path,
-        )
+        return False
     run(
-        'git', 'config', config_key, now.isoformat(),
+        'git', 'config', f'remote.{remote_name}.promisor', 'true',
+        cwd=data_path,
+    )
+    run(
+        'git', 'config', f'remote.{remote_name}.partialclonefilter', 'blob:none',
         cwd=data_path,
-        check=False,
-        stdout=subprocess.PIPE
     )
+    return True
 
 
-def get_commit_id(data_path, branch_ref):
+def get_commit_id(git_batch, branch_ref):
     """Get the Git ID (hash) for a given reference (e.g. branch name)"""
+    return git_batch.resolve(branch_ref)
+
+
+def read_git_config(data_path):
+    """Read the Git config of the given repository into a dict"""
     proc = run(
-        'git', 'rev-parse', branch_ref,
+        'git', 'config', '--list', '-z',
         cwd=data_path,
+        check=False,
         stdout=subprocess.PIPE,
     )
-    return proc.stdout.strip()
+    result = {}
+    for entry in proc.stdout.split('\0'):
+        if entry:
+            key, sep, value = entry.partition('\n')
+            result[key] = value
+    return result
 
 
-def make_worktree(data_path, branch_ref, context):
+class GitBatch:
+    """Context manager for a long-running `git cat-file --batch-check` process
+
+    Resolves Git references without starting a new process for each one.
+    Also holds the repository's Git config, read once on entering.
+    Can be shared by several threads.
+    """
+    def __init__(self, data_path):
+        self.data_path = data_path
+        self.config = {}
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.config = read_git_config(self.data_path)
+        cmd = ['git', 'cat-file', '--batch-check=%(objectname)']
+        printerr('$', ' '.join(_quote_cmd_word(c) for c in cmd), '&')
+        self.proc = subprocess.Popen(
+            cmd,
+            cwd=self.data_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding='utf-8',
+            env=command_env(os.environ),
+        )
+        return self
+
+    def __exit__(self, tp, val, tb):
+        self.proc.stdin.close()
+        returncode = self.proc.wait()
+        printerr('git cat-file ->', returncode)
+
+    def resolve(self, ref):
+        """Get the Git ID (hash) for a given reference"""
+        with self.lock:
+            self.proc.stdin.write(ref + '\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        if not line:
+            raise ValueError(f'git cat-file exited while resolving {ref}')
+        result = line.strip()
+        if ' ' in result:
+            # "<ref> missing" or "<ref> ambiguous"
+            raise ValueError(f'Cannot resolve Git reference: {result}')
+        return result
+
+
+def make_worktree(data_path, branch_ref, context, scratch_path=None):
     """Make a Git worktree with the given reference.
 
     The directory is removed when the `context` ExitStack exits.
     """
-    worktree_path = context.enter_context(tempdir_path())
-    run(
-        'git', 'worktree', 'add', worktree_path, branch_ref,
-        cwd=data_path,
-        check=False,
-    )
-    context.callback(
-        run, 'git', 'worktree', 'remove', '-f', worktree_path,
-        cwd=data_path,
-    )
+    worktree_path = context.enter_context(tempdir_path(scratch_path))
+    with _git_lock:
+        run(
+            'git', 'worktree', 'add', worktree_path, branch_ref,
+            cwd=data_path,
+            check=False,
+        )
+    context.callback(_remove_worktree, data_path, worktree_path)
     return Path(worktree_path)
 
 
+def _remove_worktree(data_path, worktree_path):
+    with _git_lock:
+        run(
+            'git', 'worktree', 'remove', '-f', worktree_path,
+            cwd=data_path,
+        )
+
+
 def choose_get_image(worktree):
     """Choose which to use for archiving. Return the function to create it."""
     if (worktree / 'Pipfile.lock').exists():
@@ -222,39 +421,52 @@ def get_image_piptools(data_path, worktree, cache_path, container_command):
         )
     reqs = (worktree / 'requirements.txt').read_text()
     reqs = fixes.fix_old_requirements_txt(reqs)
-    (worktree / 'requirements-fixed.txt').write_text(reqs)
-    print('requirements-fixed.txt:')
-    print(textwrap.indent(reqs, '    '))
+    with _print_lock:
+        print('requirements-fixed.txt:', textwrap.indent(reqs, '    '), sep='\n')
     # piptools takes a lot of time; cache the result
-    reqs_hash = hashlib.sha256(reqs.encode()).hexdigest()
+    reqs_hash = hash_text(reqs)
     cache_dir = cache_path / f'piptools-{python_version}-{reqs_hash}'
     output_path = cache_dir / 'output.txt'
-    if output_path.exists():
-        result = output_path.read_text()
-    else:
-        proc = run(
-            container_command, 'run',
-            '--rm',
-            '-v', f'{worktree}:/naucse/wd:O',
-            '-v', f'{data_path / PIP_CACHE_DIR}:/naucse/pip-cache:rw,U,Z',
-            name,
-            CONTAINER_PYTHON_COMMAND, '-m', 'piptools', 'compile',
-            '--generate-hashes',
-            '--output-file=-',
-            'requirements-fixed.txt',
-            stdout=subprocess.PIPE,
-            input=reqs,
-        )
-        (worktree / 'requirements-fixed.txt').unlink()
-        result = proc.stdout
-        cache_dir.mkdir(parents=True, exist_ok=True)
-        (cache_dir / 'input.txt').write_text(reqs)
-        output_path.write_text(result)
+    # Another thread may be compiling the same requirements; wait for it
+    # and use its result
+    with _piptools_locks[cache_dir]:
+        try:
+            result = _load_piptools_cache(cache_dir)
+        except FileNotFoundError:
+            (worktree / 'requirements-fixed.txt').write_text(reqs)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            run_to_file(
+                container_command, 'run',
+                '--rm',
+                '-v', f'{worktree}:/naucse/wd:O',
+                '-v', f'{data_path / PIP_CACHE_DIR}:/naucse/pip-cache:rw,U,Z',
+                name,
+                CONTAINER_PYTHON_COMMAND, '-m', 'piptools', 'compile',
+                '--generate-hashes',
+                '--output-file=-',
+                'requirements-fixed.txt',
+                dest=output_path,
+                input=reqs,
+            )
+            (worktree / 'requirements-fixed.txt').unlink()
+            (cache_dir / 'input.txt').write_text(reqs)
+            result = _load_piptools_cache(cache_dir)
     return get_image_from_requirements(container_command, data_path, python_version, result)
 
+@lru_cache(maxsize=None)
+def _load_piptools_cache(cache_dir):
+    """Get cached output of `piptools compile`
+
+    Raises FileNotFoundError if it's not cached. (Such misses aren't memoized.)
+    """
+    return (cache_dir / 'output.txt').read_text()
+
 def get_image_from_requirements(container_command, data_path, python_version, reqs):
     """Get a container image given a set of requirements."""
-    reqs_hash = hashlib.sha256(reqs.encode()).hexdigest()
+    reqs_hash = hash_text(reqs)
+    key = python_version, reqs_hash
+    if key in _image_name_cache:
+        return _image_name_cache[key]
     name = f'localhost/naucse-py{python_version}-{reqs_hash}'
     base_name = get_python_image(container_command, python_version)
     with ImageMaker(container_command, name) as imgm:
@@ -269,9 +481,11 @@ def get_image_from_requirements(container_command, data_path, python_version, re
         imgm.add_build_args(
             '-v', f'{data_path / PIP_CACHE_DIR}:/naucse/pip-cache:rw,U,Z',
         )
+    _image_name_cache[key] = name
     return name
 
 
+@lru_cache(maxsize=None)
 def get_python_image(container_command, python_version):
     """Get a base container image for the given Python version."""
     name = f'localhost/naucse-py{python_version}'
@@ -290,33 +504,42 @@ def save_env_info(container_command, worktree, commit_id, image_name, slug, resu
     """Save reference info about a given container image."""
     envinfo_path = result_path / 'env-info'
     envinfo_path.mkdir()
-    with envinfo_path.joinpath('os-release').open('w') as f:
-        run(
-            container_command, 'run', '--rm', image_name,
-            'cat', '/etc/os-release',
-            stdout=f,
-        )
-    with envinfo_path.joinpath('dnf.txt').open('w') as f:
-        run(
-            container_command, 'run', '--rm', image_name,
-            'dnf', 'list', 'installed',
-            stdout=f,
-        )
-    with envinfo_path.joinpath('pip.txt').open('w') as f:
-        run(
-            container_command, 'run', '--rm', image_name,
-            CONTAINER_PYTHON_COMMAND, '-m', 'pip', 'freeze', '--all',
-            stdout=f,
-        )
+    # Each command needs its own container; run them in parallel
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(
+                _container_output_to_file, container_command, image_name, cmd,
+                envinfo_path / filename,
+            )
+            for filename, cmd in (
+                ('os-release', ['cat', '/etc/os-release']),
+                ('dnf.txt', ['dnf', 'list', 'installed']),
+                ('pip.txt', [CONTAINER_PYTHON_COMMAND, '-m', 'pip', 'freeze', '--all']),
+            )
+        ]
+        for future in futures:
+            future.result()
     with envinfo_path.joinpath('source-commit.txt').open('w') as f:
         print(commit_id, file=f)
     with envinfo_path.joinpath('course.txt').open('w') as f:
         print(slug, file=f)
 
 
-def save_course(container_command, worktree, course_def, commit_id, image_name, slug, result_path):
+def _container_output_to_file(container_command, image_name, cmd, out_path):
+    """Run a command in a new container, saving its output to a file"""
+    run_to_file(
+        container_command, 'run', '--rm', image_name,
+        *cmd,
+        dest=out_path,
+    )
+
+
+def save_course(container_command, worktree, course_def, commit_id, image_name, slug, result_path, scratch_path):
     """Save the given course."""
-    info = get_course(container_command, worktree, image_name, slug)
+    info = get_course(
+        container_command, worktree, image_name, slug,
+        scratch_path=scratch_path,
+    )
     course = info['course']
     course.setdefault('etag', commit_id)
 
@@ -342,7 +565,7 @@ def save_course(container_command, worktree, course_def, commit_id, image_name,
                 lesson_slugs.add(lesson_slug)
     course['lessons'] = save_lessons(
         container_command, worktree, image_name, result_path,
-        lesson_slugs, course_vars,
+        lesson_slugs, course_vars, scratch_path=scratch_path,
     )
 
     course.setdefault('edit_info', {
@@ -355,76 +578,84 @@ def save_course(container_command, worktree, course_def, commit_id, image_name,
 
     return commit_id
 
-def save_lessons(container_command, worktree, image_name, result_path, lesson_slugs, course_vars, _done_slugs=()):
-    """Save all lessons from a course."""
+def save_lessons(container_command, worktree, image_name, result_path, lesson_slugs, course_vars, scratch_path):
+    """Save all lessons from a course.
+
+    Lessons linked from the given ones are included; the runner finds them.
+    `scratch_path` is a temporary directory; the rendered pages
+    are written to it, and moved to `result_path`.
+    """
     result = {}
-    for try_number in range(50):
-        info = get_lessons(
-            container_command, worktree, image_name, sorted(lesson_slugs),
-            course_vars,
-        )
-        data = info.pop('data')
-        _done_slugs = set(_done_slugs)
-        for slug, lesson in data.items():
-            _done_slugs.add(slug)
-            if '.' in slug:
-                raise ValueError(slug)
-            outpath = joinpath(result_path / 'lessons', slug.lower())
-            outpath.mkdir(parents=True, exist_ok=False)
-            for name, page in lesson['pages'].items():
-                content = page.pop('content')
-                content_path = joinpath(outpath, f'{name}.html')
-                content_path.write_text(content)
-                lesson_slugs.update(fixes.find_lesson_slugs(content))
-                page['content'] = {
+    info = get_lessons(
+        container_command, worktree, image_name, sorted(lesson_slugs),
+        course_vars, scratch_path=scratch_path,
+    )
+    for slug, lesson in info['data'].items():
+        if '.' in slug:
+            raise ValueError(slug)
+        outpath = joinpath(result_path / 'lessons', slug.lower())
+        outpath.mkdir(parents=True, exist_ok=False)
+        for name, page in lesson['pages'].items():
+            content_path = joinpath(outpath, f'{name}.html')
+            shutil.move(page.pop('content'), content_path)
+            page['content'] = {
+                'path': str(content_path.relative_to(result_path)),
+            }
+            for index, solution in enumerate(page.get('solutions', ())):
+                content_path = joinpath(outpath, f'solution-{index}.html')
+                shutil.move(solution.pop('content'), content_path)
+                solution['content'] = {
                     'path': str(content_path.relative_to(result_path)),
                 }
-                for index, solution in enumerate(page.get('solutions', ())):
-                    content = solution.pop('content')
-                    content_path = joinpath(outpath, f'solution-{index}.html')
-                    content_path.write_text(content)
-                    lesson_slugs.update(fixes.find_lesson_slugs(content))
-                    solution['content'] = {
-                        'path': str(content_path.relative_to(result_path)),
-                    }
-            for name, info in lesson['static_files'].items():
-                static_dir = joinpath(outpath, 'static')
-                static_dir.mkdir(parents=True, exist_ok=True)
-                srcpath = joinpath(worktree, info['path'])
-                name = re.sub('[^a-z0-9./_-]+', '-', name.lower())
-                destpath = joinpath(static_dir, name)
-                info['path'] = str(destpath.relative_to(result_path))
-                destpath.parent.mkdir(parents=True, exist_ok=True)
-                if destpath.exists():
-                    raise ValueError(f'{destpath} already exists')
+        for name, info in lesson['static_files'].items():
+            static_dir = joinpath(outpath, 'static')
+            static_dir.mkdir(parents=True, exist_ok=True)
+            srcpath = joinpath(worktree, info['path'], resolve=True)
+            name = _STATIC_NAME_UNSAFE_RE.sub('-', name.lower())
+            destpath = joinpath(static_dir, name)
+            info['path'] = str(destpath.relative_to(result_path))
+            destpath.parent.mkdir(parents=True, exist_ok=True)
+            if destpath.exists():
+                raise ValueError(f'{destpath} already exists')
+            try:
+                # The worktree is on the same filesystem (see archive())
+                # and isn't modified; a hard link avoids copying
+                os.link(srcpath, destpath)
+            except OSError:
                 shutil.copy(srcpath, destpath)
 
-            result[slug] = lesson
-
-        lesson_slugs -= _done_slugs
-        if not lesson_slugs:
-            break
-    else:
-        raise ValueError(f'Lessons are linked too deeply')
+        result[slug] = lesson
 
     return result
 
-def get_course(container_command, worktree, image_name, slug):
+def get_course(container_command, worktree, image_name, slug, scratch_path=None):
     return get_data(
         container_command, worktree, image_name,
         'naucse_render', 'get_course', [slug], {'version': 1, 'path': '.'},
+        scratch_path=scratch_path,
     )
 
-def get_lessons(container_command, worktree, image_name, slugs, course_vars):
+def get_lessons(container_command, worktree, image_name, slugs, course_vars, scratch_path):
+    """Get the given lessons, and all lessons linked from them
+
+    Page contents are not returned as strings, but as paths to files
+    in `scratch_path`.
+    """
     return get_data(
         container_command, worktree, image_name,
-        'naucse_render', 'get_lessons', [slugs],
-        {'vars': course_vars, 'path': '.'},
+        'naucse_render', 'get_lessons_transitive', [slugs],
+        {'vars': course_vars, 'path': '.', '_files_mode': True},
+        scratch_path=scratch_path,
     )
 
-def get_data(container_command, worktree, image_name, mod, obj, args, kwargs):
-    """Run a Python function in a container and get data out."""
-    with tempdir_path() as tempdir:
+def get_data(container_command, worktree, image_name, mod, obj, args, kwargs, scratch_path=None):
+    """Run a Python function in a container and get data out.
+
+    If `kwargs` has a true `_files_mode` entry, the runner writes strings
+    under `content` keys to files, and they are returned as Paths.
+    These files are removed on return unless `scratch_path` is given.
+    """
+    with tempdir_path(scratch_path) as tempdir:
         inpath = tempdir / 'input.json'
         outpath = tempdir / 'output.json'
         runnerpath = tempdir / 'runner.py'
@@ -442,21 +673,44 @@ def get_data(container_command, worktree, image_name, mod, obj, args, kwargs):
             '/naucse/aux/input.json', '/naucse/aux/output.json',
         )
         with open(outpath, encoding='utf-8') as f:
-            return json.load(f)
+            return json.load(f, object_hook=partial(_resolve_file_ref, tempdir))
+
+
+def _resolve_file_ref(base, obj):
+    """JSON object hook: resolve {"__file__": path} written by the runner"""
+    if obj.keys() == {'__file__'}:
+        return joinpath(base, obj['__file__'], resolve=True)
+    return obj
 
 
 @contextlib.contextmanager
-def tempdir_path():
+def tempdir_path(parent=None):
+    """Context manager for a temporary directory. Yields its Path.
+
+    If `parent` is given, the directory is made inside it and is *not*
+    removed on exit. `parent` should be a temporary directory itself.
+    """
+    if parent is not None:
+        yield Path(tempfile.mkdtemp(dir=parent, prefix='naucse-tmp-'))
+        return
     with tempfile.TemporaryDirectory(prefix='naucse-tmp-') as dirname:
         yield Path(dirname)
 
 
-def joinpath(base, end):
+def joinpath(base, end, resolve=False):
     """Like Path.joinpath(), but ensures the result is inside `base`.
 
     Should be used for user-supplied `end`.
+
+    Unless `end` contains `..` or is absolute, only the path string is
+    checked, without looking at the filesystem. Use `resolve=True` if
+    `base` may contain symlinks (i.e. it's not a directory we populated).
     """
-    result = (base / end).resolve()
+    end = os.fspath(end)
+    if resolve or end.startswith('/') or '..' in end.split('/'):
+        result = (base / end).resolve()
+    else:
+        result = Path(os.path.normpath(base / end))
     if base not in result.parents:
         print(base, end, result)
         raise ValueError(end)
@@ -473,35 +727,38 @@ class ImageMaker:
         self.name = name
         self.context = contextlib.ExitStack()
         self.extra_build_args = []
-        self.containerfile = None
+        self._lines = []
         self.tempdir = None
 
-    def write(self, *args, **kwargs):
-        print(*args, **kwargs, file=self.containerfile)
-
+    def write(self, *args, sep=' ', end='\n'):
+        """Add to the Containerfile. Works like print()."""
+        self._lines.append(sep.join(str(a) for a in args) + end)
 
     def add_build_args(self, *args):
         self.extra_build_args.extend(args)
 
     def __enter__(self):
         if self.name:
-            proc = run(
-                self.container_command, 'image', 'exists', self.name,
-                check=False,
-            )
-            if proc.returncode == 0:
-                self.write = lambda *a, **ka: None
+            self.context.enter_context(_image_locks[self.name])
+            exists = _image_exists_cache.get(self.name)
+            if exists is None:
+                proc = run(
+                    self.container_command, 'image', 'exists', self.name,
+                    check=False,
+                )
+                exists = _image_exists_cache[self.name] = (proc.returncode == 0)
+            if exists:
+                # Nothing to build; written lines will be ignored
                 return self
         self.tempdir = self.context.enter_context(tempdir_path())
-        self.containerfile = self.context.enter_context(
-            (self.tempdir / 'Containerfile').open('w', encoding='utf-8')
-        )
         return self
 
     def __exit__(self, tp, val, tb):
         try:
-            if tp is None and self.containerfile:
-                self.containerfile.close()
+            if tp is None and self.tempdir:
+                (self.tempdir / 'Containerfile').write_text(
+                    ''.join(self._lines), encoding='utf-8',
+                )
                 if self.name:
                     self.add_build_args('-t', self.name)
                 proc = run(
@@ -510,18 +767,46 @@ class ImageMaker:
                 )
                 if not self.name:
                     self.name = proc.stdout.strip()
+                _image_exists_cache[self.name] = True
         finally:
             self.context.close()
 
+def hash_text(text):
+    """Hash a string, for use in cache keys and image names
+
+    Not meant for security. BLAKE2b is in hashlib, and faster than SHA-256.
+    (Caches and images keyed by older SHA-256 hashes are not reused.)
+    """
+    return hashlib.blake2b(text.encode(), digest_size=32).hexdigest()
+
 def repr_args_kwargs(args, kwargs):
-    """Pretty-print arguments to a function"""
-    repr_args = ', '.join(repr(a) for a in args)
+    """Pretty-print arguments to a function
+
+    Long values are abbreviated, unless the NAUCSE_VERBOSE_ARGS
+    environment variable is set to a non-empty value.
+    """
+    if os.environ.get('NAUCSE_VERBOSE_ARGS'):
+        _repr = repr
+    else:
+        _repr = _short_repr
+    repr_args = ', '.join(_repr(a) for a in args)
     if not kwargs:
         return f'({repr_args})'
-    repr_kwargs = ', '.join(f'{k}={v!r}' for k, v in kwargs.items())
+    repr_kwargs = ', '.join(f'{k}={_repr(v)}' for k, v in kwargs.items())
     return f'({repr_args}, {repr_kwargs})'
 
+def _short_repr(value, limit=80):
+    """Like repr(), but abbreviates long lists and long results"""
+    if isinstance(value, list) and len(value) > 5:
+        shown = ', '.join(repr(v) for v in value[:3])
+        return f'[{shown}, ... {len(value) - 3} more]'
+    result = repr(value)
+    if len(result) > limit:
+        return result[:limit] + '...'
+    return result
+
 
+@lru_cache(maxsize=None)
 def git_config_key(string):
     """Convert arbitrary string to a Git config key.
 
@@ -529,42 +814,149 @@ def git_config_key(string):
     The variable names are case-insensitive, allow only alphanumeric
     characters and -, and must start with an alphabetic character. 
     """
-    def _replacement(match):
-        char = match[0]
-        result = dict(['.p', '/s', ':k', '?q', '=i', '#g']).get(char)
-        if result:
-            return '-' + result
-        value = ord(char)
-        if value <= 0xff:
-            return f'-{value:-2x}'
-        elif value <= 0xffff:
-            return f'-u{value:-4x}'
-        elif value <= 0xffffffff:
-            return f'-m{value:-8x}'
-        else:
-            raise ValueError(match)
-    string = re.sub('[^a-z0-9]', _replacement, string)
+    if string.isascii():
+        string = string.translate(_CONFIG_KEY_ASCII_TABLE)
+    else:
+        string = _CONFIG_KEY_UNSAFE_RE.sub(
+            lambda match: _escape_config_key_char(match[0]), string,
+        )
     if not string or string[0] in '0123456789x':
         return 'x' + string
     else:
         return string
 
+def _escape_config_key_char(char):
+    """Escape a character that's not allowed in git_config_key output"""
+    result = dict(['.p', '/s', ':k', '?q', '=i', '#g']).get(char)
+    if result:
+        return '-' + result
+    value = ord(char)
+    if value <= 0xff:
+        return f'-{value:-2x}'
+    elif value <= 0xffff:
+        return f'-u{value:-4x}'
+    elif value <= 0xffffffff:
+        return f'-m{value:-8x}'
+    else:
+        raise ValueError(char)
+
+# Escapes of all ASCII characters, for str.translate() in git_config_key
+_CONFIG_KEY_ASCII_TABLE = {
+    i: _escape_config_key_char(chr(i))
+    for i in range(128)
+    if _CONFIG_KEY_UNSAFE_RE.match(chr(i))
+}
+
 RUNNER = """
 ''' This code launches a task, serialized as JSON.
 '''
 
 from importlib import import_module
+from html.parser import HTMLParser
+from functools import partial
+import urllib.parse
+import itertools
 import json
 import sys
+import os
+
+
+NAUCSE_PAGE_PREFIX = 'naucse:page'
+
+
+class LessonLinkParser(HTMLParser):
+    '''Collects slugs of lessons linked with `naucse:page` URLs'''
+    def __init__(self):
+        super().__init__()
+        self.slugs = set()
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            # Cheap prefix check first; most links aren't naucse: ones.
+            # (URL schemes are case-insensitive.)
+            if (
+                name in ('href', 'src') and value
+                and value[:len(NAUCSE_PAGE_PREFIX)].lower() == NAUCSE_PAGE_PREFIX
+            ):
+                link = urllib.parse.urlparse(value)
+                if link.scheme == 'naucse' and link.path == 'page':
+                    # Split on '&' only, like parse_qs(separator='&'),
+                    # which older Pythons in the containers don't have
+                    qs = urllib.parse.parse_qs(link.query.replace(';', '%3B'))
+                    self.slugs.update(qs.get('lesson', ()))
+
+
+def find_lesson_slugs(html):
+    parser = LessonLinkParser()
+    parser.feed(html)
+    parser.close()
+    return parser.slugs
+
+
+def get_lessons_transitive(get_lessons, lesson_slugs, **kwargs):
+    '''Like get_lessons, but also get all lessons linked from the result'''
+    result = None
+    to_get = set(lesson_slugs)
+    done = set()
+    for try_number in range(50):
+        info = get_lessons(sorted(to_get), **kwargs)
+        if result is None:
+            result = info
+        else:
+            result['data'].update(info['data'])
+        done.update(to_get)
+        done.update(info['data'])
+        linked = set()
+        for lesson in info['data'].values():
+            for page in lesson['pages'].values():
+                linked.update(find_lesson_slugs(page['content']))
+                for solution in page.get('solutions', ()):
+                    linked.update(find_lesson_slugs(solution['content']))
+        to_get = linked - done
+        if not to_get:
+            break
+    else:
+        raise ValueError('Lessons are linked too deeply')
+    return result
+
+
+def write_contents(value, base_dir, counter):
+    '''Write strings under "content" keys to files in base_dir/out
+
+    The strings are replaced by {"__file__": <path relative to base_dir>}.
+    '''
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'content' and isinstance(item, str):
+                filename = 'out/{}.html'.format(next(counter))
+                path = os.path.join(base_dir, filename)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(item)
+                value[key] = {'__file__': filename}
+            else:
+                write_contents(item, base_dir, counter)
+    elif isinstance(value, list):
+        for item in value:
+            write_contents(item, base_dir, counter)
+
 
 with open(sys.argv[1], encoding='utf-8') as infile:
     module_name, obj_name, args, kwargs = json.load(infile)
+files_mode = kwargs.pop('_files_mode', False)
 
 obj = import_module(module_name)
-obj = getattr(obj, obj_name)
+if obj_name == 'get_lessons_transitive' and not hasattr(obj, obj_name):
+    obj = partial(get_lessons_transitive, obj.get_lessons)
+else:
+    obj = getattr(obj, obj_name)
 
 result = obj(*args, **kwargs)
 
+if files_mode:
+    base_dir = os.path.dirname(sys.argv[2])
+    os.mkdir(os.path.join(base_dir, 'out'))
+    write_contents(result, base_dir, itertools.count())
+
 with open(sys.argv[2], 'w', encoding='utf-8') as outfile:
     json.dump(result, outfile)
 """
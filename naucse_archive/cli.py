@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import contextlib
 import sys
 import json
 
@@ -6,7 +8,7 @@ import click
 import yaml
 
 from naucse_archive.definitions import find_definitions
-from naucse_archive.archival import archive
+from naucse_archive.archival import archive, fetch_all, GitBatch
 
 
 @click.option(
@@ -33,12 +35,17 @@ from naucse_archive.archival import archive
     help="Container tool to use (`podman` or `docker`). "
         + "(Note that docker is untested, please report any issues with it.)",
 )
+@click.option(
+    "-j", "--jobs", "jobs",
+    default=8, type=click.IntRange(min=1),
+    help="Number of courses to archive in parallel. Default: 8.",
+)
 @click.argument(
     "course_slugs", metavar="COURSE_SLUGS",
     nargs=-1,
 )
 @click.command()
-def main(data_path, output_path, course_slugs, container_tool, cache_path):
+def main(data_path, output_path, course_slugs, container_tool, cache_path, jobs):
     """Archive course(s) that use naucse_render 0.x
 
     Courses can be selected by passing their slugs as positional arguments.
@@ -58,13 +65,32 @@ def main(data_path, output_path, course_slugs, container_tool, cache_path):
 
     result = {}
 
-    for course in courses:
-        try:
-            slug, info = archive(course, data_path, output_path, cache_path, container_tool)
-        except:
-            print(f'Error archiving {course["slug"]}', file=sys.stderr)
-            raise
-        result[slug] = info
+    with contextlib.ExitStack() as context:
+        git_batch = context.enter_context(GitBatch(data_path))
+        fetch_all(data_path, courses, git_batch)
+
+        # Archival is mostly waiting for git and containers; run courses in
+        # parallel threads.
+        executor = context.enter_context(
+            ThreadPoolExecutor(max_workers=min(jobs, len(courses)))
+        )
+        futures = {
+            executor.submit(
+                archive,
+                course, data_path, output_path, cache_path, container_tool,
+                git_batch,
+            ): course
+            for course in courses
+        }
+        for future in as_completed(futures):
+            try:
+                slug, info = future.result()
+            except:
+                course = futures[future]
+                print(f'Error archiving {course["slug"]}', file=sys.stderr)
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            result[slug] = info
 
     print()
     print('Add this to courses.yml:')
@@ -3,26 +3,52 @@ from pathlib import Path
 from fnmatch import fnmatch
 import difflib
 import io
+import os
 
 import yaml
 
 
+# The C-accelerated loader is much faster, but not always available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 def find_definitions(path, patterns):
     """Find definitions of courses in the current directory.
     """
-    for basename, glob in (
-        ('courses', '*/link.yml'),
-        ('runs', '*/*/link.yml'),
+    for basename, depth in (
+        ('courses', 1),     # courses/*/link.yml
+        ('runs', 2),        # runs/*/*/link.yml
     ):
         base = path / basename
-        for p in base.glob(glob):
-            slug = str(p.relative_to(base).parent)
-            if globs_match(slug, patterns):
+        for slug in _find_dirs(base, depth):
+            if not globs_match(slug, patterns):
+                continue
+            link_path = os.path.join(base, slug, 'link.yml')
+            if os.path.isfile(link_path):
+                with open(link_path, 'rb') as f:
+                    source = yaml.load(f, Loader=YAML_LOADER)
                 yield {
-                    'source': yaml.safe_load(p.read_text()),
+                    'source': source,
                     'slug': slug,
                 }
 
 
+def _find_dirs(path, depth, prefix=''):
+    """Yield relative names of directories exactly `depth` levels under path
+    """
+    try:
+        entries = os.scandir(path)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir():
+                name = prefix + entry.name
+                if depth > 1:
+                    yield from _find_dirs(entry.path, depth - 1, name + '/')
+                else:
+                    yield name
+
+
 def globs_match(name, patterns):
     return any(fnmatch(name, pattern) for pattern in patterns)